@@ -1,17 +1,37 @@
 import yaml
+import asyncio
 import subprocess
 import json
+import re
+import glob
 import os
-import shutil
 import eyed3
 from eyed3.id3.frames import ImageFrame
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image
+import numpy as np
 import io
 import errno
+import select
+import signal
 import time
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from eyed3 import AudioFile
+from yt_dlp import YoutubeDL
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class FileLockException(Exception):
@@ -20,8 +40,9 @@ class FileLockException(Exception):
 
 class FileLock(object):
     """ A file locking mechanism that has context-manager support so
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+        you can use it in a with statement. On POSIX it takes an flock() on
+        the lockfile so waiters sleep in the kernel; elsewhere it falls back
+        to exclusively creating the lockfile and retrying every `delay` seconds.
     """
 
     def __init__(self, file_name, timeout=10, delay=.05):
@@ -35,13 +56,17 @@ class FileLock(object):
         self.file_name = file_name
         self.timeout = timeout
         self.delay = delay
+        self._flocked = False
 
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `wait` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws
-            an exception.
+        """ Acquire the lock, if possible. If the lock is in use, it waits until
+            it either gets the lock or exceeds `timeout` number of seconds, in
+            which case it throws an exception.
         """
+        if fcntl is not None:
+            self._acquire_flock()
+            return
+
         start_time = time.time()
         while True:
             try:
@@ -59,14 +84,55 @@ class FileLock(object):
 
     #        self.is_locked = True
 
+    def _acquire_flock(self):
+        """ Take an exclusive flock() on the lockfile. A blocked flock() is
+            interrupted by a SIGALRM timer once `timeout` seconds have passed.
+        """
+        fd = os.open(self.lockfile, os.O_CREAT | os.O_RDWR)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if self.timeout is None:
+                    raise FileLockException("Could not acquire lock on {}".format(self.file_name))
+                if self.timeout <= 0:
+                    raise FileLockException("Timeout occured.")
+                self._wait_flock(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+        self._flocked = True
+        self.is_locked = True
+
+    def _wait_flock(self, fd):
+        def on_timeout(signum, frame):
+            raise FileLockException("Timeout occured.")
+
+        previous = signal.signal(signal.SIGALRM, on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
     def release(self):
-        """ Get rid of the lock by deleting the lockfile.
+        """ Get rid of the lock by unlocking or deleting the lockfile.
             When working in a `with` statement, this gets automatically
             called at the end.
         """
         if self.is_locked:
-            os.close(self.fd)
-            os.unlink(self.lockfile)
+            if self._flocked:
+                # The lockfile is left in place, unlinking it would let another
+                # process lock a fresh file while a waiter still holds the old one
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self._flocked = False
+            else:
+                os.close(self.fd)
+                os.unlink(self.lockfile)
             self.is_locked = False
 
     def __enter__(self):
@@ -91,41 +157,181 @@ class FileLock(object):
         self.release()
 
 
-YT = "/usr/local/bin/youtube-dl"
 MP3GAIN = "/usr/bin/mp3gain"
-TMP_DIR = "/app/tmp"
+DEFAULT_WORKERS = 4
+PLAYLIST_WORKERS = 4
+INDEX_FILE = ".yts_index.json"
+PARTIAL_PREFIX = ".partial."
+# Covers are square and at most COVER_SIZE px a side
+COVER_SIZE = 480
+# Shrink so the longer side is at most COVER_SIZE then pad square, the ffmpeg equivalent of handle_thumbnail
+THUMBNAIL_FILTER = (rf"scale=w=min(iw\,{COVER_SIZE}):h=min(ih\,{COVER_SIZE}):force_original_aspect_ratio=decrease,"
+                    r"pad=max(iw\,ih):max(iw\,ih):(ow-iw)/2:(oh-ih)/2:black")
+# Everything but letters, digits and spaces, Unicode-aware so non-Latin titles survive. Unlike the old
+# str.isalpha/isdigit filter it also keeps numeric symbols such as '½' (\w covers all of str.isalnum)
+_SANITIZE = re.compile(r"(?:[^\w ]|_)+")
 LOCKFILE = os.path.abspath(os.path.join(os.path.dirname(__file__), "lockfile"))
 
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
-def generate_thumbnail(path):
-    data = None
-    response = requests.get(path)
-    if response.status_code == 200:
-        data = response.content
-
-    if data is None:
-        return None
-    return handle_thumbnail(data)
+_YDL_LOCAL = threading.local()
 
 
 def handle_thumbnail(input_bytes):
     image = Image.open(io.BytesIO(input_bytes))
 
-    result = image
     width, height = image.size
-    if width > height:
-        result = Image.new(image.mode, (width, width), (0, 0, 0))
-        result.paste(image, (0, (width - height) // 2))
+    if width == height and width <= COVER_SIZE and image.format == "JPEG":
+        return input_bytes
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    if max(width, height) > COVER_SIZE:
+        scale = COVER_SIZE / max(width, height)
+        width, height = max(round(width * scale), 1), max(round(height * scale), 1)
+        image = image.resize((width, height))
 
-    elif width < height:
-        result = Image.new(image.mode, (height, height), (0, 0, 0))
-        result.paste(image, ((height - width) // 2, 0))
+    result = image
+    if width != height:
+        arr = np.asarray(image)
+        size = max(width, height)
+        top = (size - height) // 2
+        left = (size - width) // 2
+
+        out = np.zeros((size, size) + arr.shape[2:], dtype=arr.dtype)
+        out[top:top + height, left:left + width] = arr
+        result = Image.fromarray(out)
 
     img_byte_arr = io.BytesIO()
-    result.save(img_byte_arr, format="PNG")
+    result.save(img_byte_arr, format="JPEG", quality=85, optimize=False)
     return img_byte_arr.getvalue()
 
 
+def _wait_proc(proc):
+    """ Block until `proc` exits by polling a pidfd, so the kernel wakes us
+        exactly once when the child is done. Falls back to `proc.wait()` where
+        pidfd_open isn't available (non-Linux or kernels older than 5.3).
+    """
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        return proc.wait()
+
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        poller.poll()
+    finally:
+        os.close(fd)
+    return proc.wait()
+
+
+def _metadata_ydl():
+    """ The YoutubeDL used for playlist metadata. One instance is kept per thread
+        and reused, YoutubeDL tracks per-extraction state and isn't safe to share.
+    """
+    ydl = getattr(_YDL_LOCAL, "ydl", None)
+    if ydl is None:
+        ydl = _YDL_LOCAL.ydl = YoutubeDL({"quiet": True, "no_warnings": True, "noprogress": True,
+                                          "ignoreerrors": True, "extract_flat": "in_playlist"})
+    return ydl
+
+
+def _remove_partials(videos, output_directory):
+    """ Delete whatever yt-dlp left behind for `videos` under the staging prefix:
+        .part files, intermediate audio, thumbnails and files that never got moved.
+    """
+    for v in videos:
+        pattern = os.path.join(glob.escape(output_directory), glob.escape(f"{PARTIAL_PREFIX}{v.id}.") + "*")
+        for path in glob.glob(pattern):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _download_params(output_directory, output_format):
+    """ YoutubeDL options equivalent to what `yt_dlp.parse_options` gives for the old command line:
+        -i -q -o <template> followed by either -f mp4 or -x --audio-format mp3 --embed-thumbnail
+        --convert-thumbnails jpg --ppa ThumbnailsConvertor:...
+    """
+    params = {
+        "quiet": True,
+        "noprogress": True,
+        "ignoreerrors": True,
+        "outtmpl": {"default": os.path.join(output_directory, PARTIAL_PREFIX + "%(id)s.%(ext)s")},
+    }
+    postprocessors = []
+    if output_format == 0:
+        # Let yt-dlp embed the cover art while it's already running ffmpeg, scaled and padded like handle_thumbnail.
+        # The convertor skips thumbnails that are already jpg, save_metadata handles those instead.
+        params.update({
+            "format": "bestaudio/best",
+            "final_ext": "mp3",
+            "writethumbnail": True,
+            "postprocessor_args": {"thumbnailsconvertor": ["-vf", THUMBNAIL_FILTER]},
+        })
+        params["outtmpl"]["pl_thumbnail"] = ""
+        postprocessors += [
+            {"key": "FFmpegThumbnailsConvertor", "format": "jpg", "when": "before_dl"},
+            # preferredquality is the CLI's --audio-quality default, VBR -q:a 5 rather than ffmpeg's 128k CBR
+            {"key": "FFmpegExtractAudio", "preferredcodec": "mp3", "preferredquality": "5", "nopostoverwrites": False},
+            {"key": "EmbedThumbnail", "already_have_thumbnail": False},
+        ]
+    else:
+        params["format"] = "mp4"
+    postprocessors.append({"key": "FFmpegConcat", "only_multi_video": True, "when": "playlist"})
+    params["postprocessors"] = postprocessors
+    return params
+
+
+def download_videos(videos, output_directory, output_format=0):
+    """ Download every video with a single YoutubeDL instance and a single mp3gain run.
+        Files are staged as hidden `.partial.` files inside `output_directory` so
+        moving them into place is a rename on the same filesystem, not a copy.
+    """
+    for v in videos:
+        if not v.id:
+            raise Exception("No ID given to be able to download")
+
+    os.makedirs(output_directory, exist_ok=True)
+    output_ext = "mp3" if output_format == 0 else "mp4"
+
+    params = _download_params(output_directory, output_format)
+
+    try:
+        with YoutubeDL(params) as ydl:
+            ydl.download([f"https://www.youtube.com/watch?v={v.id}" for v in videos])
+
+        downloaded = []
+        for v in videos:
+            tmp_path = os.path.join(output_directory, f"{PARTIAL_PREFIX}{v.id}.{output_ext}")
+            if os.path.isfile(tmp_path):
+                downloaded.append((v, tmp_path))
+            else:
+                print(f"Failed to download {v.title}-{v.id}")
+
+        if not downloaded:
+            return
+
+        if output_format == 0:
+            command = [MP3GAIN, "-r", "-c", "-q"] + [tmp_path for _, tmp_path in downloaded]
+            # No preexec_fn or user/group changes, so CPython starts mp3gain with vfork()
+            # instead of a full fork() of this (fairly large) process. Keep it that way.
+            result = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+            _wait_proc(result)
+
+        for v, tmp_path in downloaded:
+            out_path = v.output_path(output_directory, output_ext)
+            os.replace(tmp_path, out_path)
+            v.filepath = out_path
+            v._initial_save = True
+    finally:
+        _remove_partials(videos, output_directory)
+
+
 class Video:
     def __init__(self, format=0):
         self.title = None
@@ -147,6 +353,8 @@ class Video:
         self._update_album_thumbnail = None
 
         self._initial_save = False
+        self._saved_index = None
+        self._saved_thumbnail = None
 
     def __repr__(self):
         return f"{self.title}:{self.id} - {self.index}"
@@ -169,7 +377,8 @@ class Video:
     def set_index(self, index):
         if index != self.index:
             self.index = index
-            self._update_index = True
+            # Only flag a change against what's on disk, the index can be moved and moved back during a sync
+            self._update_index = index != self._saved_index
 
     def set_album_artist(self, artist):
         if artist != self.album_artist:
@@ -193,46 +402,16 @@ class Video:
             self.save_metadata()
 
     def download(self, output_directory):
-        if not self.id:
-            raise Exception("No ID given to be able to download")
+        download_videos([self], output_directory, self.format)
 
-        if not os.path.isdir(TMP_DIR):
-            os.mkdir(TMP_DIR)
+    def output_path(self, output_directory, output_ext):
+        output_name = _SANITIZE.sub("", f"{self.title}").rstrip()
 
-        output_name = f"{self.title}"
-        output_name = "".join(c for c in output_name if c.isalpha() or c.isdigit() or c == ' ').rstrip()
-        output_ext = "mp3" if self.format == 0 else "mp4"
-
-        tmp_path = os.path.join(TMP_DIR, self.id) + "." + output_ext
         out_path = os.path.join(output_directory, f"{output_name}.{output_ext}")
         if os.path.isfile(out_path):
             output_name += f" - {self.id}"
             out_path = os.path.join(output_directory, f"{output_name}.{output_ext}")
-
-        command = f"{YT} -o {tmp_path} -q "
-        if self.format == 0:
-            command += f"-x --audio-format {output_ext} "
-        else:
-            command += f"-f {output_ext} "
-        command += f"https://www.youtube.com/watch?v={self.id}"
-
-        result = subprocess.Popen(command, stderr=subprocess.PIPE, shell=True)
-        result.wait()
-
-        if not (result.returncode == 0 or result.returncode is None):
-            print(f"Failed to download {self.title}-{self.id}: {result.stderr.read().decode()}")
-            return
-
-        if not os.path.isdir(output_directory):
-            os.mkdir(output_directory)
-
-        command = f"{MP3GAIN} -r -c -q {tmp_path}"
-        result = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        result.wait()
-
-        shutil.move(tmp_path, out_path)
-        self.filepath = out_path
-        self._initial_save = True
+        return out_path
 
     def save_metadata(self):
         if not (self._initial_save or self._update_title or self._update_channel or
@@ -252,15 +431,37 @@ class Video:
                 file.tag.title = self.title
             if self._initial_save or self._update_channel:
                 file.tag.artist = self.channel
-            if self._initial_save or self._update_thumbnail:
-                for index in range(len(file.tag.comments)):
-                    i = file.tag.comments[index]
-                    if i.text == "thumbnail_url":
-                        file.tag.comments.remove(i.text)
+
+            # New downloads already have their cover embedded by yt-dlp, but its convertor (and the
+            # filter with it) skips thumbnails that are already jpg, so those still need handling here
+            cover_written = self._initial_save
+            if self._initial_save:
+                covers = [i for i in file.tag.images if i.picture_type == ImageFrame.FRONT_COVER]
+                for cover in covers:
+                    width, height = Image.open(io.BytesIO(cover.image_data)).size
+                    if width != height or width > COVER_SIZE:
+                        file.tag.images.set(ImageFrame.FRONT_COVER, handle_thumbnail(cover.image_data),
+                                            "image/jpeg", cover.description)
+
+            elif self._update_thumbnail:
+                try:
+                    response = _SESSION.get(self.thumbnail, timeout=10)
+                except requests.RequestException:
+                    response = None
+                if response is not None and response.status_code == 200:
+                    file.tag.images.set(ImageFrame.FRONT_COVER, handle_thumbnail(response.content), "image/jpeg")
+                    cover_written = True
+
+            if cover_written:
+                # The url lives in the description, so set() alone would add a frame next to the old one
+                stale = [i.description for i in file.tag.comments if i.text == "thumbnail_url"]
+                for description in stale:
+                    file.tag.comments.remove(description)
                 file.tag.comments.set("thumbnail_url", self.thumbnail)
-                thumbnail = generate_thumbnail(self.thumbnail)
-                if thumbnail:
-                    file.tag.images.set(ImageFrame.FRONT_COVER, handle_thumbnail(thumbnail), "image/png")
+                self._saved_thumbnail = self.thumbnail
+            elif self._update_thumbnail:
+                # Keep the old url, on disk and in the index, so the cover is retried next run
+                self.thumbnail = self._saved_thumbnail
 
             if self._initial_save or self._update_index:
                 file.tag.track_num = self.index
@@ -269,6 +470,8 @@ class Video:
                 file.tag.album_artist = self.album_artist
             file.tag.save()
 
+            self._saved_index = self.index
+
 
 class YoutubeVideo(Video):
     def __init__(self, data, **kwargs):
@@ -277,7 +480,12 @@ class YoutubeVideo(Video):
         self.title = data["title"]
         self.id = data["id"]
         self.channel = data["channel"]
-        self.thumbnail = sorted(data["thumbnails"], key=lambda x: x["height"], reverse=True)[0]["url"]
+        # Smallest variant whose longer side still reaches COVER_SIZE, players never show cover art bigger than that.
+        # This is the image used when a cover is refreshed. New downloads embed yt-dlp's own pick, scaled to the
+        # same size, so thumbnail_url names the source variant rather than the exact embedded bytes.
+        longer_side = lambda x: max(x.get("width") or 0, x["height"])
+        self.thumbnail = min((t for t in data["thumbnails"] if longer_side(t) >= COVER_SIZE), key=longer_side,
+                             default=max(data["thumbnails"], key=longer_side))["url"]
         self.index = data.get("index")
         self.filepath = None
         self.playlist = data.get("playlist_title")
@@ -285,17 +493,28 @@ class YoutubeVideo(Video):
 
 
 class LocalVideo(Video):
-    def __init__(self, filepath, **kwargs):
+    CACHED_FIELDS = ("id", "title", "channel", "album_artist", "index", "playlist", "thumbnail")
+
+    def __init__(self, filepath, cached=None, **kwargs):
         super().__init__()
 
         ext = filepath.split(".")[-1]
-        if ext == "mp3":
+        if cached is not None:
+            for key in self.CACHED_FIELDS:
+                setattr(self, key, cached.get(key))
+            self.filepath = filepath
+            self.format = 0
+            self._saved_index = self.index
+            self._saved_thumbnail = self.thumbnail
+
+        elif ext == "mp3":
             file = eyed3.load(filepath)
             self.title = file.tag.title
             self.channel = file.tag.artist
             self.album_artist = file.tag.album_artist
 
             self.index = file.tag.track_num.count
+            self._saved_index = self.index
             self.filepath = filepath
             self.format = 0
             self.playlist = file.tag.album
@@ -305,6 +524,7 @@ class LocalVideo(Video):
                     self.id = i.description
                 elif i.text == "thumbnail_url":
                     self.thumbnail = i.description
+            self._saved_thumbnail = self.thumbnail
 
 
 class Playlist:
@@ -313,6 +533,8 @@ class Playlist:
         self.url = data[0].strip()
         self.filepath = data[1]["filepath"]
         self.mode = 1 if data[1].get("format", "").lower() == "video" else 0
+        self.workers = int(data[1].get("workers", DEFAULT_WORKERS))
+        self._remote_info = None
 
     def sync(self):
         local = self.get_local_state() # Local first to take into account album artist
@@ -329,8 +551,48 @@ class Playlist:
             if index != v.index:
                 v.set_index(index)
 
-        for _, v in local.items():
-            v.sync(output_directory=self.filepath)
+        missing = [v for v in local.values() if v.filepath is None]
+        if missing:
+            self._download_batch(missing)
+
+        downloaded = [v for v in local.values() if v.filepath is not None]
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            list(ex.map(lambda v: v.save_metadata(), downloaded))
+
+        self._save_index(downloaded)
+
+    def _download_batch(self, videos):
+        download_videos(videos, self.filepath, self.mode)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.filepath, INDEX_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, videos):
+        if not os.path.isdir(self.filepath):
+            return
+
+        index = {}
+        for v in videos:
+            if v.format != 0:
+                continue
+            try:
+                stat = os.stat(v.filepath)
+            except OSError:
+                continue
+            index[os.path.basename(v.filepath)] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                **{key: getattr(v, key) for key in LocalVideo.CACHED_FIELDS}
+            }
+
+        index_path = os.path.join(self.filepath, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
 
     def add_album_artist(self, artist):
         if artist is None:
@@ -343,14 +605,23 @@ class Playlist:
         if self.album_artists != artist:
             self.album_artists = "Various Artists"
 
+    async def fetch_remote(self):
+        self._remote_info = await asyncio.to_thread(self._extract_remote)
+
+    def _extract_remote(self):
+        info = _metadata_ydl().extract_info(self.url, download=False)
+        if info is None:
+            return {}
+        # Same plain data `youtube-dl -J` printed, it has to survive pickling into the pool
+        return YoutubeDL.sanitize_info(info)
+
     def get_remote_state(self):
-        command = f"{YT} --flat-playlist -q -J --no-warnings {self.url}"
+        if self._remote_info is None:
+            asyncio.run(self.fetch_remote())
 
-        result = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        result_raw = result.stdout.read()
-        if len(result_raw) == 0:
+        data = self._remote_info
+        if not data:
             return None
-        data = json.loads(result_raw.decode())
         title = data.get("title")
 
         for i in data["entries"]:
@@ -368,32 +639,50 @@ class Playlist:
         if not os.path.exists(self.filepath):
             return {}
 
-        for filename in os.listdir(self.filepath):
-            ext = filename.split(".")[-1]
-            if ext not in ["mp3", "pm4"]:
-                continue
-
-            f = LocalVideo(os.path.join(self.filepath, filename))
-            if f.id:
-                output[f.id] = f
-                self.add_album_artist(f.channel)
+        index = self._load_index()
+        with os.scandir(self.filepath) as it:
+            for entry in it:
+                if not entry.is_file() or entry.name.startswith(PARTIAL_PREFIX) or \
+                        not entry.name.endswith((".mp3", ".mp4")):
+                    continue
+
+                # Reuse the tags from the last run unless the file has been touched since
+                cached = index.get(entry.name)
+                if cached is not None:
+                    stat = entry.stat()
+                    if (cached["mtime"], cached["size"]) != (stat.st_mtime_ns, stat.st_size):
+                        cached = None
+
+                f = LocalVideo(entry.path, cached=cached)
+                if f.id:
+                    output[f.id] = f
+                    self.add_album_artist(f.channel)
         return output
 
 
+async def fetch_remote_states(playlists):
+    await asyncio.gather(*[p.fetch_remote() for p in playlists])
+
+
 def main():
     print("Starting", flush=True)
 
     config_file = "/config.yaml"
 
     with open(config_file, "r") as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=YamlLoader)
 
     playlists = []
     for i in config.items():
         playlists.append(Playlist(i))
 
-    for i in playlists:
-        i.sync()
+    if playlists:
+        asyncio.run(fetch_remote_states(playlists))
+        with multiprocessing.Pool(processes=min(len(playlists), PLAYLIST_WORKERS)) as p:
+            p.map(Playlist.sync, playlists)
+            # Leaving the block terminates the workers, let them exit and flush their output first
+            p.close()
+            p.join()
 
     print("Finished", flush=True)
 